@@ -1,43 +1,156 @@
 import os
+import functools
 import biom
 import numpy as np
 import pandas as pd
-import birdman
-from scipy.stats.mstats import gmean
-from birdman.model_base import TableModel, SingleFeatureModel
-from sklearn.preprocessing import LabelEncoder
-import warnings
+from birdman.model_base import TableModel, SingleFeatureModel, ModelIterator
+from cmdstanpy import CmdStanModel
+
+
+def _median_ratios(table, max_bytes=2 ** 25):
+    """ DESeq2 median of ratios size factors, computed on sparse counts.
+
+    With a 0.5 pseudocount, log(k + 0.5) = log(0.5) + log1p(2k), so the
+    log1p term is zero wherever the count is zero.  The log geometric
+    mean of each feature then only needs the nonzero entries, and every
+    zero count of a feature shares the same ratio.  Ratios are scattered
+    into one reused dense (samples x features) buffer holding as many
+    samples as fit in `max_bytes` (at least one), which bounds the peak
+    memory regardless of the number of samples.
+    """
+    mat = table.matrix_data.tocsc()
+    F, N = mat.shape
+    chunksize = max(1, max_bytes // (8 * F))
+    logk = np.log1p(2 * mat.data)
+    # log(K / Km) = log1p(2k) - mean(log1p(2k)) over samples
+    log_gm = np.bincount(mat.indices, weights=logk, minlength=F) / N
+    zero_ratio = np.exp(-log_gm)
+    # samples x features, so each sample's ratios are contiguous
+    buf = np.empty((min(chunksize, N), F))
+    lo, hi = (F - 1) // 2, F // 2
+    slog = np.empty(N)
+    for i in range(0, N, chunksize):
+        j = min(i + chunksize, N)
+        block = buf[:j - i]
+        block[:] = zero_ratio
+        start, end = mat.indptr[i], mat.indptr[j]
+        rows = mat.indices[start:end]
+        cols = np.repeat(np.arange(j - i), np.diff(mat.indptr[i:j + 1]))
+        block[cols, rows] = np.exp(logk[start:end] - log_gm[rows])
+        # median along features via an in-place partial sort
+        block.partition([lo, hi], axis=1)
+        slog[i:j] = np.log((block[:, lo] + block[:, hi]) / 2)
+    return slog
 
 
 def _normalization_func(table, norm='depth'):
     if norm == 'median_ratios':
-        K = table.matrix_data.todense().T + 0.5
-        Km = gmean(counts, axis=0)
-        slog = np.log(np.median(K / Km, axis=1))
+        slog = _median_ratios(table)
     elif norm == 'depth':
-        slog = np.log(table.sum(axis='sample'))
+        depths = np.asarray(table.matrix_data.sum(axis=0)).ravel()
+        slog = np.log(depths)
     else:
         raise ValueError('`normalization` must be specified.')
     return slog
 
 
 def _swap(vec, x, y):
-    idx = (vec == x)
-    idy = (vec == y)
-    new_vec = vec.copy()
-    new_vec[idx] = y
-    new_vec[idy] = x
-    return new_vec
+    return np.where(vec == x, y, np.where(vec == y, x, vec))
+
+
+def _stan_key(stan_path):
+    # a stat is cheap enough to do for every model; hashing is not
+    return stan_path, os.path.getmtime(stan_path)
+
+
+@functools.lru_cache(maxsize=None)
+def _get_compiled(stan_path, mtime):
+    # mtime is only part of the cache key, so an edited .stan file
+    # gets recompiled rather than served stale
+    return CmdStanModel(stan_file=stan_path)
+
 
+def _compile_once(stan_path):
+    """ Compiles a Stan model once per process and reuses it.
 
-def relabel(x):
-    encoder = LabelEncoder()
-    encoder.fit(x)
-    ids = encoder.transform(x)
-    return ids, encoder
+    Forked workers inherit the compiled model, so the per-feature
+    models don't each have to invoke cmdstan.
+    """
+    return _get_compiled(*_stan_key(stan_path))
+
+
+class _CachedCompileMixin:
+    """ Gets compile_model() from the per-process compile cache.
+
+    Compiling stays lazy, so models can be built without a CmdStan
+    toolchain until they are fit.
+    """
+    def compile_model(self):
+        self.sm = _compile_once(self.model_path)
 
 
-class DiseaseSingle(SingleFeatureModel):
+def relabel(x, start=0):
+    # missing labels get their own level, as with LabelEncoder, rather
+    # than a -1 sentinel that would fall outside Stan's 1-based ids
+    codes, uniques = pd.factorize(x, sort=True, use_na_sentinel=False)
+    # astype already copies, so the shift can be done in place
+    ids = codes.astype(np.int32)
+    ids += start
+    return ids, uniques
+
+
+def _disease_single_params(table, metadata, category_column,
+                           match_ids_column, batch_column, reference,
+                           normalization='depth', sample_ids=None):
+    """ Table-level Stan inputs for DiseaseSingle.
+
+    None of these depend on the feature being fit, so they can be
+    computed once and shared across all of the per-feature models.
+    The category labels are returned under ``diseases`` and the sample
+    ids the inputs are aligned to under ``sample_ids``.
+    `sample_ids` defaults to ``table.ids()``.
+    """
+    if sample_ids is None:
+        sample_ids = table.ids()
+    # skip the reindex when the metadata is already aligned to the table
+    if not metadata.index.equals(pd.Index(sample_ids)):
+        metadata = metadata.loc[sample_ids]
+    # pulls down the category information (i.e. health vs different diseases)
+    case_ids, case_uniques = relabel(
+        metadata[match_ids_column].values, start=1)
+    batch_ids, batch_uniques = relabel(
+        metadata[batch_column].values, start=1)
+    disease_ids, disease_uniques = relabel(
+        metadata[category_column].values, start=1)
+
+    # Swap with reference
+    # disease_ids, disease_encoder = swap_classes(
+    #     disease_ids, disease_encoder, reference)
+    disease = disease_uniques
+    ref_id = np.searchsorted(disease_uniques, reference)
+    if ref_id == len(disease) or disease[ref_id] != reference:
+        raise ValueError(f'`reference` {reference} not found in '
+                         f'{category_column}.')
+
+    # log of sequencing depth
+    slog = _normalization_func(table, normalization)
+    return {
+        "C" : len(metadata) // 2,           # number of controls
+        "N" : len(metadata),                # number of samples
+        "B" : len(batch_uniques),           # number of batches
+        "D" : len(disease_uniques),         # number of diseases and healthy
+        "slog": slog,
+        "reference" : int(ref_id) + 1,
+        "disease_ids": disease_ids,
+        "cc_ids": case_ids,                 # matching ids
+        "batch_ids" : batch_ids,            # aka study ids
+        "control_loc": -np.log(table.shape[0]),
+        "diseases": disease,
+        "sample_ids": np.asarray(sample_ids)
+    }
+
+
+class DiseaseSingle(_CachedCompileMixin, SingleFeatureModel):
     """A model includes multiple diseases.
 
     Parameters
@@ -48,6 +161,11 @@ class DiseaseSingle(SingleFeatureModel):
         Name of feature of interest
     metadata : pd.DataFrame
         Sample metadata file
+    precomputed : dict, optional
+        Table-level inputs from `_disease_single_params`.  If not
+        specified, they are computed from the table and metadata.
+        If specified, `metadata`, `category_column`, `match_ids_column`,
+        `batch_column`, `reference` and `normalization` are not used.
     ...
 
     """
@@ -67,7 +185,8 @@ class DiseaseSingle(SingleFeatureModel):
                  num_warmup: int = 1000,
                  normalization: str = 'depth',
                  chains: int = 4,
-                 seed: float = 42):
+                 seed: float = 42,
+                 precomputed: dict = None):
 
         filepath =  os.path.join(os.path.dirname(__file__),
                                  'assets/disease_single.stan')
@@ -78,47 +197,25 @@ class DiseaseSingle(SingleFeatureModel):
                          num_warmup=num_warmup,
                          chains=chains,
                          seed=seed)
-        metadata = metadata.loc[table.ids()]
-        # pulls down the category information (i.e. health vs different diseases)
-        case_ids, case_encoder = relabel(metadata[match_ids_column].values)
-        batch_ids, batch_encoder = relabel(metadata[batch_column].values)
-        disease_ids, disease_encoder = relabel(metadata[category_column].values)
-
-        # Swap with reference
-        # disease_ids, disease_encoder = swap_classes(
-        #     disease_ids, disease_encoder, reference)
-        disease = disease_encoder.classes_
-
-        # log of sequencing depth
-        slog = _normalization_func(table, normalization)
-        #number of controls
-        C = len(metadata) // 2
-        #number of samples
-        N = len(metadata)
-        #number of batches
-        B = len(np.unique(batch_ids))
-        #number of diseases and healthy
-        D = len(np.unique(disease_ids))
-
-        control_loc = np.log(1. / len(table.ids(axis='observation')))
+        if precomputed is None:
+            precomputed = _disease_single_params(
+                table, metadata, category_column, match_ids_column,
+                batch_column, reference, normalization,
+                sample_ids=self.sample_names)
+        param_dict = dict(precomputed)
+        disease = param_dict.pop("diseases")
+        sample_ids = param_dict.pop("sample_ids")
+        if not np.array_equal(sample_ids, self.sample_names):
+            raise ValueError('`precomputed` is not aligned to the samples '
+                             'of the table.')
         control_scale = 3
         batch_scale = 3
-        param_dict = {
-            "C" : C,
-            "N" : N,
-            "B" : B,
-            "D" : D,
-            "slog": slog,
-            "reference" : int(disease_encoder.transform([reference])) + 1,
-            "disease_ids": disease_ids + 1,
-            "cc_ids": case_ids + 1,                 # matching ids
-            "batch_ids" : batch_ids + 1,            # aka study ids
-            "control_loc": control_loc,
+        param_dict.update({
             "control_scale": control_scale,
             "batch_scale":batch_scale,
             "diff_scale": diff_scale,
             "disp_scale": disp_scale
-        }
+        })
         self.add_parameters(param_dict)
         self.specify_model(
             #specify priors for all parameters
@@ -147,7 +244,37 @@ class DiseaseSingle(SingleFeatureModel):
         )
 
 
-class DESeq2(TableModel):
+class DiseaseModelIterator(ModelIterator):
+    """ Iterates over DiseaseSingle models for every feature in a table.
+
+    The table-level inputs (ids, sequencing depths, ...) are computed
+    once and shared by all of the per-feature models.
+    """
+    def __init__(self,
+                 table: biom.Table,
+                 metadata: pd.DataFrame,
+                 category_column: str,
+                 match_ids_column: str,
+                 batch_column: str,
+                 reference: str,
+                 normalization: str = 'depth',
+                 num_chunks: int = None,
+                 **kwargs):
+        precomputed = _disease_single_params(
+            table, metadata, category_column, match_ids_column,
+            batch_column, reference, normalization)
+        super().__init__(table, DiseaseSingle, num_chunks=num_chunks,
+                         metadata=metadata,
+                         category_column=category_column,
+                         match_ids_column=match_ids_column,
+                         batch_column=batch_column,
+                         reference=reference,
+                         normalization=normalization,
+                         precomputed=precomputed,
+                         **kwargs)
+
+
+class DESeq2(_CachedCompileMixin, TableModel):
     """ A model to mimic DESeq2. """
     def __init__(self,
                  table: biom.table.Table,
@@ -170,13 +297,15 @@ class DESeq2(TableModel):
                          num_warmup=num_warmup,
                          chains=chains,
                          seed=seed)
-        cats = metadata[category_column]
-        other = list(set(cats) - {reference})[0]
+        cats_str = metadata[category_column].values
         if reference is None:
-            reference = cats[0]
-        cats = (cats.values != reference).astype(np.int64) + 1
+            reference = cats_str[0]
+        uniq = pd.unique(cats_str)
+        other = uniq[uniq != reference][0]
+        # 1 for the reference group, 2 for the other group
+        cats = np.where(cats_str == reference, np.int8(1), np.int8(2))
         slog = _normalization_func(table, normalization)
-        control_loc = np.log(1. / len(table.ids(axis='observation')))
+        control_loc = -np.log(table.shape[0])
         control_scale = 5
         param_dict = {
             "slog": slog,
@@ -205,7 +334,7 @@ class DESeq2(TableModel):
         )
 
 
-class SingleDESeq2(SingleFeatureModel):
+class SingleDESeq2(_CachedCompileMixin, SingleFeatureModel):
     """ A model to mimic DESeq2. """
     def __init__(self,
                  table: biom.table.Table,
@@ -229,14 +358,15 @@ class SingleDESeq2(SingleFeatureModel):
                          num_warmup=num_warmup,
                          chains=chains,
                          seed=seed)
-        cats = metadata[category_column]
-        other = list(set(cats) - {reference})[0]
+        cats_str = metadata[category_column].values
         if reference is None:
-            reference = cats[0]
-        cats = (cats.values != reference).astype(np.int64) + 1
-        other = list(set(cats) - {reference})[0]
+            reference = cats_str[0]
+        uniq = pd.unique(cats_str)
+        other = uniq[uniq != reference][0]
+        # 1 for the reference group, 2 for the other group
+        cats = np.where(cats_str == reference, np.int8(1), np.int8(2))
         slog = _normalization_func(table, normalization)
-        control_loc = np.log(1. / len(table.ids(axis='observation')))
+        control_loc = -np.log(table.shape[0])
         control_scale = 1
         param_dict = {
             "slog": slog,
@@ -264,8 +394,15 @@ class SingleDESeq2(SingleFeatureModel):
             log_likelihood="log_lhood"
         )
 
-def _single_func(x):
+def _single_func(x, control=None):
     fid, m = x
-    m.compile_model()
-    m.fit_model({'adapt_delta': 0.99, 'max_treedepth': 20})
+    if control is None:
+        control = {'adapt_delta': 0.8, 'max_treedepth': 10}
+    if m.sm is None:
+        m.compile_model()
+    # birdman already runs all chains of a fit in parallel
+    # (parallel_chains=chains), so a single fit uses `chains` cores.
+    # When fits are also mapped over a Pool, size it to
+    # os.cpu_count() // chains to avoid oversubscribing.
+    m.fit_model({**control, 'threads_per_chain': 1})
     return m.to_inference()
@@ -3,7 +3,6 @@ import numpy as np
 import pandas as pd
 from skbio.stats.composition import (closure, alr, alr_inv,
                                      multiplicative_replacement)
-from sklearn.preprocessing import LabelEncoder
 from cmdstanpy import CmdStanModel, CmdStanMCMC
 import tempfile
 import json
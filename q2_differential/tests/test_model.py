@@ -17,6 +17,9 @@ from q2_differential._matching import _matchmaker
 from skbio.stats.composition import alr_inv, clr
 from multiprocessing import Pool
 from q2_differential._model import _swap, DiseaseSingle
+from q2_differential._model import _normalization_func, relabel
+from q2_differential._model import _disease_single_params
+from scipy.stats.mstats import gmean
 import pytest
 
 
@@ -31,9 +34,85 @@ class TestDiseaseSingle(unittest.TestCase):
         expx = np.array([1,1,1,0,0,0,0,0,0,2,2,2])
         npt.assert_allclose(y, expx)
 
+    def test_relabel(self):
+        x = np.array(['b', 'a', 'c', 'a', 'b'], dtype=object)
+        ids, uniques = relabel(x, start=1)
+        npt.assert_array_equal(ids, np.array([2, 1, 3, 1, 2]))
+        npt.assert_array_equal(uniques, np.array(['a', 'b', 'c']))
+        self.assertEqual(ids.dtype, np.int32)
+
+    def test_relabel_missing(self):
+        x = np.array(['b', np.nan, 'a', 'b'], dtype=object)
+        ids, uniques = relabel(x, start=1)
+        npt.assert_array_equal(ids, np.array([2, 3, 1, 2]))
+        self.assertEqual(len(uniques), 3)
+        self.assertTrue(pd.isnull(uniques[-1]))
+
+    def test_median_ratios(self):
+        state = np.random.RandomState(0)
+        counts = state.poisson(1, size=(20, 12))
+        table = Table(counts, [f'o{i}' for i in range(20)],
+                      [f's{i}' for i in range(12)])
+        K = counts.T + 0.5
+        exp = np.log(np.median(K / gmean(K, axis=0), axis=1))
+        res = _normalization_func(table, 'median_ratios')
+        npt.assert_allclose(res, exp)
+
+
+    def test_precomputed(self):
+        table = biom.load_table(get_data_path('biom_test_6.biom'))
+        metadata = pd.read_table(
+            get_data_path('sample_metadata_6.txt'), index_col=0)
+        args = ('Status', 'match_ids_column', 'batch_column', 'Healthy')
+        fid = table.ids(axis='observation')[0]
+        exp = DiseaseSingle(table, fid, metadata, *args)
+        pre = _disease_single_params(table, metadata, *args)
+        res = DiseaseSingle(table, fid, metadata, *args, precomputed=pre)
+        self.assertEqual(exp.dat.keys(), res.dat.keys())
+        for k in exp.dat:
+            npt.assert_array_equal(exp.dat[k], res.dat[k])
+        self.assertEqual(exp.coords['disease_ids'],
+                         res.coords['disease_ids'])
+
+    def test_precomputed_mismatch(self):
+        table = biom.load_table(get_data_path('biom_test_6.biom'))
+        metadata = pd.read_table(
+            get_data_path('sample_metadata_6.txt'), index_col=0)
+        args = ('Status', 'match_ids_column', 'batch_column', 'Healthy')
+        pre = _disease_single_params(table, metadata, *args)
+        fid = table.ids(axis='observation')[0]
+        sub = table.filter(table.ids()[:4], inplace=False)
+        with self.assertRaises(ValueError):
+            DiseaseSingle(sub, fid, metadata, *args, precomputed=pre)
+        # same samples, different order
+        shuffled = table.sort_order(table.ids()[::-1])
+        with self.assertRaises(ValueError):
+            DiseaseSingle(shuffled, fid, metadata, *args, precomputed=pre)
 
     def test_sim(self):
         pass
 
+class TestDESeq2(unittest.TestCase):
+
+    def setUp(self):
+        counts = np.arange(1, 25).reshape(4, 6)
+        self.table = Table(counts, [f'o{i}' for i in range(4)],
+                           [f's{i}' for i in range(6)])
+        self.metadata = pd.DataFrame(
+            {'group': ['ctrl', 'case', 'ctrl', 'case', 'case', 'ctrl']},
+            index=[f's{i}' for i in range(6)])
+
+    def test_default_reference(self):
+        m = DESeq2(self.table, self.metadata, 'group')
+        self.assertEqual(m.coords['groups'], ['ctrl', 'case'])
+        npt.assert_array_equal(m.dat['M'], np.array([1, 2, 1, 2, 2, 1]))
+
+    def test_single_default_reference(self):
+        m = SingleDESeq2(self.table, 'o0', self.metadata, 'group')
+        self.assertEqual(m.coords['groups'], ['ctrl', 'case'])
+        self.assertEqual(m.coords['features'], ['log(case / ctrl)'])
+        npt.assert_array_equal(m.dat['M'], np.array([1, 2, 1, 2, 2, 1]))
+
+
 if __name__ == '__main__':
     unittest.main()
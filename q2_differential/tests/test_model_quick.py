@@ -1,48 +1,45 @@
-import unittest                                                                 
-import biom                                                                     
-import pandas as pd                                                             
-import numpy as np                                                              
-from skbio.util import get_data_path                                            
-from q2_differential._model import DESeq2, SingleDESeq2, DiseaseSingle          
-from birdman import ModelIterator                                               
-from xarray.ufuncs import log2 as xlog                                          
-import pandas.testing as pdt                                                    
-from q2_differential._stan import _case_control_negative_binomial_sim           
-from q2_differential._matching import _matchmaker                               
-from skbio.stats.composition import alr_inv, clr                                
-from biom.table import Table                                                    
-from multiprocessing import Pool                                                
-from birdman.model_util import concatenate_inferences 
 import argparse
-parser = argparse.ArgumentParser()                                          
-parser.add_argument(                                                        
-     '--biom-table', help='Biom table of counts.', required=True)            
-parser.add_argument(                                                        
-     '--metadata-file', help='Sample metadata file.', required=True)         
-args = parser.parse_args()                                                  
-#print(args.biom_table)                                                      
-#table = biom.load_table(args.biom_table)                                    
-#metadata = pd.read_table(args.metadata_file, index_col=0)
+import os
+from functools import partial
+from multiprocessing import Pool
+import biom
+import pandas as pd
+from birdman.model_util import concatenate_inferences
+from q2_differential._model import _compile_once, DiseaseModelIterator
+from q2_differential._model import _single_func
+from q2_differential import _model
 
-table = biom.load_table(get_data_path('/mnt/home/djin/ceph/snakemake/data/Dan2020ASD_rl150/tenMicrobes.biom'))
-metadata = pd.read_table(get_data_path('/mnt/home/djin/ceph/snakemake/data/Dan2020ASD_rl150/metadata_simple_fake.txt'),
-                         index_col=0) 
-models = ModelIterator(table, DiseaseSingle, metadata=metadata,
-                       match_ids_column='match_ids_column',             
-                       batch_column='batch_column',reference='Healthy', 
-                       category_column='Status', num_iter=10, num_warmup=10)
 
-def _single_func(x):                                                    
-    fid, m = x                                                          
-    m.compile_model()                                                   
-    m.fit_model()                                                       
-    return m.to_inference_object()                                      
-                                                                                  
-samples = []                                                            
-for m in models:                                                        
-    inf = _single_func(m)                                               
-    samples.append(inf)                                                 
-coords = {'feature' : table.ids(axis='observation')}               
-samples = concatenate_inferences(samples, coords, 'feature')
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+         '--biom-table', help='Biom table of counts.', required=True)
+    parser.add_argument(
+         '--metadata-file', help='Sample metadata file.', required=True)
+    args = parser.parse_args()
+    table = biom.load_table(args.biom_table)
+    metadata = pd.read_table(args.metadata_file, index_col=0)
+    chains = 4
+    # compile once up front, the per-feature models reuse it
+    _compile_once(os.path.join(os.path.dirname(_model.__file__),
+                               'assets/disease_single.stan'))
+    models = DiseaseModelIterator(table, metadata=metadata,
+                                  match_ids_column='match_ids_column',
+                                  batch_column='batch_column',
+                                  reference='Healthy',
+                                  category_column='Status', num_iter=10,
+                                  num_warmup=10, chains=chains)
+
+    # each fit already runs its chains in parallel, so only hand the
+    # pool as many workers as there are free groups of cores
+    with Pool(processes=max(1, os.cpu_count() // chains)) as pool:
+        # shallow trees keep the quick test fast; not for real analyses
+        control = {'adapt_delta': 0.8, 'max_treedepth': 6}
+        # ModelIterator has no usable len() unless it is chunked, so
+        # stream it with imap as the scripts do
+        samples = list(pool.imap(partial(_single_func, control=control),
+                                 models))
+    coords = {'feature' : table.ids(axis='observation')}
+    samples = concatenate_inferences(samples, coords, 'feature')
 #def test_answer():
 #    assert                                                                             
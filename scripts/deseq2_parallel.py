@@ -42,9 +42,6 @@ if __name__ == '__main__':
     print(args)
     table = biom.load_table(args.biom_table)
     metadata = pd.read_table(args.metadata_file, index_col=0)
-    # initialize just to compile model
-    SingleDESeq2(table, metadata=metadata, feature_id=table.ids(axis='observation')[0],
-                 category_column=args.groups).compile_model()
     models = ModelIterator(table, SingleDESeq2, metadata=metadata,
                            category_column=args.groups, chains=args.chains,
                            num_iter=args.monte_carlo_samples,
@@ -52,10 +49,13 @@ if __name__ == '__main__':
 
     def _single_func(x):
         fid, m = x
-        m.compile_model()
+        if m.sm is None:
+            m.compile_model()
         m.fit_model()
         return m.to_inference_object()
 
+    # compile once in the parent, the workers reuse it
+    models[0][1].compile_model()
     samples = []
     with Pool(args.processes) as p:
         for inf in p.imap(_single_func, models, chunksize=50):
@@ -3,13 +3,13 @@ import biom
 import pandas as pd
 import numpy as np
 import xarray as xr
-from q2_differential._model import DiseaseSingle, _single_func
+from q2_differential._model import DiseaseModelIterator, _single_func
 from birdman.model_util import concatenate_inferences
-from birdman import ModelIterator
 import time
 import logging
 import subprocess, os
 import tempfile
+from functools import partial
 from multiprocessing import Pool
 import arviz as az
 
@@ -47,26 +47,23 @@ if __name__ == '__main__':
     print(args)
     table = biom.load_table(args.biom_table)
     metadata = pd.read_table(args.metadata_file, index_col=0)
-    # initialize just to compile model
-    DiseaseSingle(table, metadata=metadata,
-                  feature_id=table.ids(axis='observation')[0],
-                  category_column=args.disease_column,
-                  batch_column=args.batch_column,
-                  reference=args.reference,
-                  match_ids_column=args.match_ids).compile_model()
     # Groups should be 0, 1, 2...?
-    models = ModelIterator(table, DiseaseSingle, metadata=metadata,
-                           category_column=args.disease_column,
-                           match_ids_column=args.match_ids,
-                           batch_column=args.batch_column,
-                           reference=args.reference,
-                           chains=args.chains,
-                           num_iter=args.monte_carlo_samples,
-                           num_warmup=1000)
+    models = DiseaseModelIterator(table, metadata=metadata,
+                                  category_column=args.disease_column,
+                                  match_ids_column=args.match_ids,
+                                  batch_column=args.batch_column,
+                                  reference=args.reference,
+                                  chains=args.chains,
+                                  num_iter=args.monte_carlo_samples,
+                                  num_warmup=1000)
 
+    control = {'adapt_delta': 0.99, 'max_treedepth': 20}
+    # compile once in the parent, the workers reuse it
+    models[0][1].compile_model()
     samples = []
     with Pool(args.processes) as p:
-        for inf in p.imap(_single_func, models, chunksize=50):
+        for inf in p.imap(partial(_single_func, control=control),
+                          models, chunksize=50):
             samples.append(inf)
     coords = {'feature' : table.ids(axis='observation')}
     samples = concatenate_inferences(samples, coords, 'feature')
@@ -33,7 +33,7 @@ setup(name='q2-differential',
       install_requires=[
           'numpy',
           'scipy',
-          'pandas',
+          'pandas>=1.5',
           'xarray',
           'arviz',
           'matplotlib',